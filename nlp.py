@@ -5,8 +5,14 @@ Description: A resuable, extensible framework for compartive text analysis
             designed to work with any arbitrary collection of related docs
 """
 
-from collections import Counter, defaultdict
+from collections import Counter
+from itertools import chain
+import re
 import string
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import tempfile
+import webbrowser
 # pip install pdfplumber
 # pip install textstat
 import pdfplumber
@@ -15,112 +21,227 @@ import numpy as np
 import textstat
 from plotly.subplots import make_subplots
 
+# pip install pypdfium2 (optional, much faster than pdfplumber)
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
 import logging
 logging.getLogger("pdfminer").setLevel(logging.ERROR)
 
+# punctuation (curly apostrophes included) is dropped rather than splitting
+# words, so contractions and hyphenated words stay whole (cont'd -> contd)
+_PUNCT = str.maketrans('', '', string.punctuation + '\u2019')
+
+# a word is a run of letters, accented ones included (the text is lowercased
+# first); runs stuck to digits, like 3rd or 12b, aren't words
+_TOKEN_RE = re.compile(r"\b[^\W\d_]+\b")
+
+
+def _count_words(texts, stop_words):
+    """ Count the words of texts (a list of strings, e.g. pages) that aren't
+    stop words, in a single Counter built in one pass. Punctuation is removed
+    and anything else that isn't a letter separates words """
+    tokens = chain.from_iterable(_TOKEN_RE.findall(text.lower().translate(_PUNCT)) for text in texts)
+    return Counter(t for t in tokens if t not in stop_words)
+
+
+def _one_glyph_per_line(text):
+    """ Check whether most lines of a page hold a single character, which is
+    how pypdfium2 returns some pages (e.g. page 48 of the_brutalist) """
+    lines = [line for line in text.splitlines() if line.strip()]
+    return sum(len(line.strip()) == 1 for line in lines) > len(lines) / 2
+
+
+def _iter_pages(filename):
+    """ Yield the text of each page of a pdf one page at a time, using pypdfium2
+    when it is installed and pdfplumber otherwise """
+    if pdfium is not None:
+        pdf_file = pdfium.PdfDocument(filename)
+        plumber_file = None
+        try:
+            for i in range(len(pdf_file)):
+                page = pdf_file[i]
+                textpage = page.get_textpage()
+                text = textpage.get_text_range()
+                textpage.close()
+                page.close()
+
+                # pdfplumber lays out the pages pypdfium2 splits into single glyphs
+                if _one_glyph_per_line(text):
+                    if plumber_file is None:
+                        plumber_file = pdfplumber.open(filename)
+                    plumber_page = plumber_file.pages[i]
+                    text = plumber_page.extract_text() or ''
+                    plumber_page.close()
+
+                yield text
+        finally:
+            pdf_file.close()
+            if plumber_file is not None:
+                plumber_file.close()
+    else:
+        with pdfplumber.open(filename) as pdf_file:
+            for page in pdf_file.pages:
+                yield page.extract_text() or ''
+                page.close()  # drop pdfplumber's cached layout for the page
+
+
+def _parse_one(args):
+    """ Parse one pdf in a worker process for Text.load_texts
+    (module-level so it can be pickled) """
+    filename, stop_words = args
+    return Text().pdf_parser(filename, stop_words)
+
+
 class Text:
 
     def __init__(self):
         """ Constructor """
-        self.data = defaultdict(dict)
+        self.data = {k: {} for k in ('wordcount', 'num_words', 'num_pages', 'grade', 'poly')}
+        self._stop_cache = {}
+        self._topk_cache = {}
 
     def load_stop_words(self, stopfile):
-        """ Load a list of common or stop words.
-        These get filtered from each file automatically"""
-        with open(stopfile, 'r') as file:
-            stop_words = [line.strip() for line in file if line.strip()]
+        """ Load a set of common or stop words.
+        These get filtered from each file automatically.
+        Each file is only read once; later calls reuse the cached set """
+        stop_words = self._stop_cache.get(stopfile)
+        if stop_words is None:
+            with open(stopfile, 'r') as file:
+                stop_words = frozenset(line.strip() for line in file if line.strip())
+            self._stop_cache[stopfile] = stop_words
 
         return stop_words
 
-    def pdf_parser(self, filename, stopfile):
-        """ For processing pdf documents using pdfplumber """
-        # load stop words
-        stop_words = set(self.load_stop_words(stopfile))
-
-        # initialize raw text storage
-        raw = ""
-
-        # use pdfplumber to open and process the pdf file
-        with pdfplumber.open(filename) as pdf_file:
-            num_pages = len(pdf_file.pages)
-
-            # iterate over each page in the pdf
-            for page in pdf_file.pages:
-                text = page.extract_text()
-                if text:  # check if text was extracted
-                    raw += text + "\n"  # append text from each page
-
-        # convert to lowercase, remove punctuation
-        raw = raw.lower()
-        raw = raw.translate(str.maketrans('', '', string.punctuation))
-
-        # use regex to only keep alphabetic characters (ignore "-" and others)
-        words = [word for word in raw.split() if word.isalpha() and word not in stop_words]
-
-        # count word occurrences
-        wc = Counter(words)
-        num_words = len(words)
+    def pdf_parser(self, filename, stop_words_set):
+        """ For processing pdf documents using pypdfium2, or pdfplumber as a fallback.
+        stop_words_set is an already loaded set of stop words (see load_text);
+        a stop word file path is also accepted and loaded here """
+        # a path would otherwise be treated as a string of letters by `in`
+        if isinstance(stop_words_set, str):
+            stop_words_set = self.load_stop_words(stop_words_set)
+
+        # initialize storage for the text of each page
+        parts = []
+        num_pages = 0
+
+        for text in _iter_pages(filename):
+            num_pages += 1
+            if text:  # check if text was extracted
+                parts.append(text)  # keep text from each page
+
+        # count word occurrences across all pages at once, skipping stop words;
+        # pages are tokenized one at a time, so the text is never joined for this
+        wc = _count_words(parts, stop_words_set)
+        num_words = sum(wc.values())
+
+        # join the pages once (only textstat needs the whole text), and
+        # compute the complexity features now so the text needn't be kept
+        raw = "\n".join(parts)
+        grade = self.get_flesch_kindcaid_grade(raw)
+        poly = self.get_polysyllable_count(raw)
+        del raw, parts
 
         # return results as a dictionary
-        results = {'wordcount': wc, 'num_words': num_words, 'num_pages': num_pages, 'raw_text': raw}
+        results = {'wordcount': wc, 'num_words': num_words, 'num_pages': num_pages, 'grade': grade, 'poly': poly}
 
         return results
 
     def simple_text_parser(self, filename, stop_words):
-        """ For processing simple, unformatted text documents """
-        with open(filename, 'r') as file:
-            raw = file.read().lower()
-
-        # remove punctuation
-        raw = raw.translate(str.maketrans('', '', string.punctuation))
+        """ For processing simple, unformatted text documents.
+        stop_words is a set of stop words or a stop word file path """
+        if isinstance(stop_words, str):
+            stop_words = self.load_stop_words(stop_words)
 
-        # use regex to only keep alphabetic characters (ignore "-" and others)
-        words = [word for word in raw.split() if word.isalpha() and word not in stop_words]
+        with open(filename, 'r') as file:
+            raw = file.read()
 
-        # get word count
-        wc = Counter(words)
+        # get word count, skipping stop words
+        wc = _count_words([raw], stop_words)
 
-        return {'wordcount': wc, 'num_words': len(words)}
+        return {'wordcount': wc, 'num_words': sum(wc.values()),
+                'grade': self.get_flesch_kindcaid_grade(raw), 'poly': self.get_polysyllable_count(raw)}
 
     def load_text(self, filename, label=None, stop_words=None, parser=None):
         """ Register a text file with the library.
-        Label is an optional label to use in visualizations to identify the text """
+        Label is an optional label to use in visualizations to identify the text.
+        stop_words is a stop word file or an already loaded set of stop words """
 
         if stop_words is None:
-            stop_words = self.load_stop_words('stop_words.txt')
+            stop_words = 'stop_words.txt'
+
+        # parsers always get a set, loaded (and cached) here if a path was given
+        if isinstance(stop_words, str):
+            stop_words = self.load_stop_words(stop_words)
 
         if parser is None:
-            results = self.simple_text_parser(filename)
+            results = self.simple_text_parser(filename, stop_words)
         else:
             results = parser(filename, stop_words)
 
         if label is None:
             label = filename
 
-        # Store results in the data dictionary (self.data)
-        for k, v in results.items():
-            self.data[k][label] = v
+        self._store(label, results)
+
+    def load_texts(self, files, stop_words='stop_words.txt'):
+        """ Register several pdf files at once, parsing them in parallel.
+        files is a list of (filename, label) pairs; a label of None uses the filename """
+        # read the stop words once here rather than in every worker
+        if isinstance(stop_words, str):
+            stop_words = self.load_stop_words(stop_words)
+        jobs = [(filename, stop_words) for filename, _ in files]
 
+        # each pdf is parsed independently, so spread them over worker processes
+        with ProcessPoolExecutor() as ex:
+            for (filename, label), results in zip(files, ex.map(_parse_one, jobs)):
+                self._store(filename if label is None else label, results)
+
+    def _store(self, label, results):
+        """ Store parser results in the data dictionary (self.data) """
+        for k, v in results.items():
+            self.data.setdefault(k, {})[label] = v  # parsers may add their own keys
+        self._topk_cache.pop(label, None)  # the text's word counts may have changed
+
+    def _topk(self, label, k):
+        """ The k most common words (with counts) of a text, or all of them if k
+        is None. The sorted list is cached so each counter is only sorted once
+        across visualizations """
+        # n is how many words the cached list holds, None meaning every word
+        n, top = self._topk_cache.get(label, (0, None))
+        if top is None or (n is not None and (k is None or k > n)):
+            n = None if k is None else max(k, 50)
+            top = self.data['wordcount'][label].most_common(n)
+            self._topk_cache[label] = (n, top)
+
+        return top[:k]
 
     def wordcount_sankey(self, word_list=None, k=5):
         """ Map each text to words using a Sankey diagram."""
+        self._build_wordcount_sankey(word_list, k).show()
+
+    def _build_wordcount_sankey(self, word_list=None, k=5):
+        """ Build the wordcount Sankey figure """
         # if no word_list is given, use k_most frequent words from each document
         files = list(self.data['wordcount'].keys())
 
         if word_list is None:
             top_words_per_file = {}
             for label in files:
-                wordcount = self.data["wordcount"][label]
-                top_words = [word for word, _ in wordcount.most_common(k)]
+                top_words = [word for word, _ in self._topk(label, k)]
                 top_words_per_file[label] = top_words
 
         else:
             # if a word_list is given, use it
             top_words_per_file = {label: word_list for label in files}
 
-        # prepare for sankey
-        sources = []
-        targets = []
+        # prepare for sankey, giving sources (files) and targets (words)
+        # node ids in first-seen order as the links are built
+        node_map = {}
+        sources_indices = []
+        targets_indices = []
         values = []
 
         for label, wordcount in self.data["wordcount"].items():
@@ -128,24 +249,23 @@ class Text:
 
             for word in top_words:
                 if word in wordcount:
-                    sources.append(label)
-                    targets.append(word)
+                    sources_indices.append(node_map.setdefault(label, len(node_map)))
+                    targets_indices.append(node_map.setdefault(word, len(node_map)))
                     values.append(wordcount[word])
 
-        # unique ids for sources (files) and targets (words)
-        all_nodes = list(set(sources + targets))
-        node_map = {node: i for i, node in enumerate(all_nodes)}  # mapping
+        all_nodes = list(node_map)
 
-        # map sources and targets to node indices
-        sources_indices = [node_map[source] for source in sources]
-        targets_indices = [node_map[target] for target in targets]
+        # numeric arrays let plotly serialize the links without boxing each int
+        values = np.asarray(values, dtype=np.int32)
+        sources_indices = np.asarray(sources_indices, dtype=np.int32)
+        targets_indices = np.asarray(targets_indices, dtype=np.int32)
 
         # define a list of colors for the Sankey diagram
         colors = ['#636EFA', '#EF553B', '#00CC96', '#AB63A1', '#FF77AC', '#119DFF', '#F7B801', '#00FF00', '#FF4500']
-        node_colors = {node: colors[i % len(colors)] for i, node in enumerate(all_nodes)}  # cycle through colors
+        node_colors = [colors[i % len(colors)] for i in range(len(all_nodes))]  # cycle through colors
 
         # assign colors for links to sources
-        link_colors = [node_colors[source] for source in sources]
+        link_colors = [node_colors[i] for i in sources_indices.tolist()]
 
         # create the sankey diagram
         fig = go.Figure(go.Sankey(
@@ -154,7 +274,7 @@ class Text:
                 thickness=20,
                 line=dict(color="black", width=0.5),
                 label=all_nodes,  # labels for nodes
-                color=[node_colors[node] for node in all_nodes]  # apply color to nodes
+                color=node_colors  # apply color to nodes
             ),
             link=dict(
                 source=sources_indices,
@@ -170,10 +290,14 @@ class Text:
             height=600,
             width=900
         )
-        fig.show()
+        return fig
 
     def frequency_heatmap(self, k=10):
         """ A visualization array of subplots with one subplot for each text file"""
+        self._build_frequency_heatmap(k).show()
+
+    def _build_frequency_heatmap(self, k=10):
+        """ Build the word frequency heatmap figure """
         files = list(self.data['wordcount'].keys())
 
         # get k most common words across all documents
@@ -183,8 +307,12 @@ class Text:
 
         top_words = [word for word, _ in word_freq.most_common(k)]
 
-        # make frequency matrix
-        freq_matrix = np.array([[self.data['wordcount'][file].get(word, 0) for file in files] for word in top_words])
+        # make frequency matrix, filling a fixed-dtype buffer one file (column) at a time
+        freq_matrix = np.zeros((len(top_words), len(files)), dtype=np.int32)
+        for j, file in enumerate(files):
+            wc = self.data['wordcount'][file]
+            for i, word in enumerate(top_words):
+                freq_matrix[i, j] = wc.get(word, 0)
 
         # create heatmap
         fig = go.Figure(data=go.Heatmap(
@@ -201,10 +329,14 @@ class Text:
             height=500,
             width=1000
         )
-        fig.show()
+        return fig
 
     def frequency_barchart(self, k=10):
         """ Creates a grid of bar charts (one per screenplay) of top k words"""
+        self._build_frequency_barchart(k).show()
+
+    def _build_frequency_barchart(self, k=10):
+        """ Build the top-k words bar chart figure """
 
         files = list(self.data['wordcount'].keys())
         num_files = len(files)
@@ -221,8 +353,7 @@ class Text:
             row = idx // cols + 1
             col = idx % cols + 1
 
-            wordcount = self.data['wordcount'][label]
-            top_words = wordcount.most_common(k)
+            top_words = self._topk(label, k)
 
             words = [word for word, _ in top_words]
             counts = [count for _, count in top_words]
@@ -240,7 +371,7 @@ class Text:
             showlegend = False
         )
 
-        fig.show()
+        return fig
 
     def get_flesch_kindcaid_grade(self, text):
         """ calculate the flesch-kincaid grade level of a text """
@@ -250,11 +381,11 @@ class Text:
         """ calculate the number of polysyllables in a text """
         return textstat.polysyllabcount(text)
 
-    def get_features(self, text):
+    def get_features(self, label):
         """ gets the features of the text for the heatmap visualization """
-        word_count = self.data['wordcount'].get(text)
-        grade_level = self.get_flesch_kindcaid_grade(text)
-        polysyllable_count = self.get_polysyllable_count(text)
+        word_count = self.data['num_words'].get(label)
+        grade_level = self.data['grade'].get(label)
+        polysyllable_count = self.data['poly'].get(label)
 
         return {
             'Word Count': word_count,
@@ -264,32 +395,26 @@ class Text:
 
     def complexity_heatmap(self, k=10):
         """ visualizes the word count, polysyllable count, and grade level of a text """
+        self._build_complexity_heatmap(k).show()
+
+    def _build_complexity_heatmap(self, k=10):
+        """ Build the complexity heatmap figure """
 
         # prepare data for heatmap
         data = []
         labels = []
 
         for label in list(self.data['wordcount'].keys())[:k]:
-            text = ' '.join(self.data['wordcount'][label].keys())
-
             num_words = self.data['num_words'].get(label)
-            grade = self.get_flesch_kindcaid_grade(text)
-            polysyllable_count = self.get_polysyllable_count(text)
+            grade = self.data['grade'].get(label)
+            polysyllable_count = self.data['poly'].get(label)
 
             data.append([num_words, polysyllable_count, grade])
             labels.append(label)
 
-            # normalize values
-            max_word_count = max([item[0] for item in data])
-            max_polysyllable_count = max([item[1] for item in data])
-            max_grade = max([item[2] for item in data])
-
-            normalized_data = [
-                [num_words / max_word_count, polysyllable_count / max_polysyllable_count, grade / max_grade]
-                for num_words, polysyllable_count, grade in data
-            ]
-
-        normalized_data = np.array(normalized_data)
+        # normalize each feature by its max across all texts
+        arr = np.asarray(data, dtype=np.float64)
+        normalized_data = arr / arr.max(axis=0, keepdims=True)
 
         # create heatmap
 
@@ -316,4 +441,25 @@ class Text:
             width=800,
         )
 
-        fig.show()
\ No newline at end of file
+        return fig
+
+    def render_all(self, out_html=None):
+        """ Render all four visualizations (with their default settings) into a
+        single html page, so the page and plotly.js are only written once.
+        The page is saved to out_html if given, otherwise opened in a browser """
+        figs = [self._build_wordcount_sankey(), self._build_frequency_heatmap(),
+                self._build_frequency_barchart(), self._build_complexity_heatmap()]
+
+        # only the first figure pulls in plotly.js, the rest reuse it
+        divs = [fig.to_html(full_html=False, include_plotlyjs='cdn' if i == 0 else False)
+                for i, fig in enumerate(figs)]
+        html = '<html>\n<head><meta charset="utf-8" /></head>\n<body>\n' + '\n'.join(divs) + '\n</body>\n</html>\n'
+
+        # write utf-8 to match the meta tag, whatever the locale's default is
+        if out_html is None:
+            with tempfile.NamedTemporaryFile('w', suffix='.html', delete=False, encoding='utf-8') as file:
+                file.write(html)
+            webbrowser.open(Path(file.name).as_uri())
+        else:
+            with open(out_html, 'w', encoding='utf-8') as file:
+                file.write(html)
@@ -10,7 +10,7 @@ logging.getLogger("pdfminer").setLevel(logging.ERROR)
 text_processor = Text()
 
 # load the stop words
-stop_words = 'stop_words.txt'
+stop_words = text_processor.load_stop_words('stop_words.txt')
 
 # load pdf documents for processing
 # change the file path where you have them saved bc it's prob different
@@ -27,19 +27,13 @@ screenplays = [
     ("the_substance_screenplay.pdf", "The Substance")
 ]
 
-for filepath, label in screenplays:
-    text_processor.load_text(filepath, label=label, stop_words=stop_words, parser=text_processor.pdf_parser)
+# the guard keeps worker processes from re-running the script on import
+if __name__ == '__main__':
+    # parse all the screenplays in parallel
+    text_processor.load_texts(screenplays, stop_words=stop_words)
 
-# generate the sankey diagram for the top 5 words
-text_processor.wordcount_sankey()
-
-# display the second visualization
-text_processor.frequency_heatmap()
-
-# display the alternate second visualization
-text_processor.frequency_barchart()
-
-# display the complexity heatmap
-text_processor.complexity_heatmap()
+    # display the sankey diagram for the top 5 words, the second visualization,
+    # the alternate second visualization and the complexity heatmap on one page
+    text_processor.render_all()
 
 